@@ -3,24 +3,334 @@ import yt_dlp
 import subprocess
 import os
 import tempfile
+import functools
+import shutil
+import hashlib
+import time
+import queue
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from PIL import Image, ImageDraw, ImageFont
 
+# Processed clips are kept here rather than in a throwaway mkdtemp() directory
+# so that repeat requests can reuse them. Clips expire after CLIP_CACHE_TTL
+# seconds and only the newest CLIP_CACHE_SIZE are kept.
+CLIP_CACHE_DIR = os.environ.get('CLIPPER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'clipper_cache'))
+CLIP_CACHE_TTL = 3600
+CLIP_CACHE_SIZE = 32
+
+# Source downloads go to tmpfs when it has room, keeping their disk I/O in RAM.
+# Merging bestvideo+bestaudio briefly holds both parts and the merged file
+# (about twice the download), so three times the estimate must be free.
+SHM_DIR = '/dev/shm'
+SHM_HEADROOM_FACTOR = 3
+
+# Temporary directories are reused across requests instead of being created
+# and removed each time, with one pool per parent directory
+TEMP_DIR_POOLS = {}
+
+# Runs temp file cleanup off the request path
+CLEANUP_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+# Font used for the pre-rendered credits overlay
+CREDITS_FONT = Path(__file__).parent / 'Playfair.ttf'
+
+# When a broker is configured clips are processed by Celery workers (see tasks.py)
+# instead of inside the Streamlit script thread
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL')
+CELERY_TASK_TIMEOUT = int(os.environ.get('CLIPPER_TASK_TIMEOUT', 1800))
+
+# Hardware encoders in order of preference. Decoded frames are kept in system
+# memory so the scale/crop/overlay filters can still run on the CPU. 'probe'
+# holds the options a test encode needs to reach the device, and 'quality'
+# maps each quality option to the encoder's speed/quality settings.
+HWACCEL_PROFILES = {
+    'h264_nvenc': {
+        'name': 'h264_nvenc',
+        'input': ['-hwaccel', 'cuda'],
+        'probe': [],
+        'encoder': ['-c:v', 'h264_nvenc', '-tune', 'hq', '-rc', 'vbr'],
+        'quality': {
+            'fast': ['-preset', 'p1', '-cq', '28'],
+            'balanced': ['-preset', 'p4', '-cq', '23'],
+            'best': ['-preset', 'p7', '-cq', '20'],
+        },
+        'filter': '',
+    },
+    'h264_vaapi': {
+        'name': 'h264_vaapi',
+        'input': ['-hwaccel', 'vaapi', '-vaapi_device', '/dev/dri/renderD128'],
+        'probe': ['-vaapi_device', '/dev/dri/renderD128'],
+        'encoder': ['-c:v', 'h264_vaapi'],
+        'quality': {
+            'fast': ['-qp', '28'],
+            'balanced': ['-qp', '23'],
+            'best': ['-qp', '20'],
+        },
+        'filter': ',format=nv12,hwupload',
+    },
+    'h264_videotoolbox': {
+        'name': 'h264_videotoolbox',
+        'input': ['-hwaccel', 'videotoolbox'],
+        'probe': [],
+        'encoder': ['-c:v', 'h264_videotoolbox'],
+        'quality': {
+            'fast': ['-q:v', '50'],
+            'balanced': ['-q:v', '65'],
+            'best': ['-q:v', '80'],
+        },
+        'filter': '',
+    },
+}
+
+# libx264 fallback. -tune fastdecode disables CABAC and deblocking, so it is
+# left out of the "best" option.
+SOFTWARE_PROFILE = {
+    'name': 'libx264',
+    'input': [],
+    'encoder': ['-c:v', 'libx264'],
+    'quality': {
+        'fast': ['-preset', 'ultrafast', '-crf', '28', '-tune', 'fastdecode'],
+        'balanced': ['-preset', 'faster', '-crf', '23', '-tune', 'fastdecode'],
+        'best': ['-preset', 'slow', '-crf', '20'],
+    },
+    'filter': '',
+}
+
+# Quality options offered in the UI
+QUALITY_OPTIONS = ('fast', 'balanced', 'best')
+
+# Seconds per component for ss, mm:ss and hh:mm:ss
+TIME_COEFFICIENTS = ((1,), (60, 1), (3600, 60, 1))
+
+@functools.lru_cache(maxsize=128)
 def parse_time(time_str):
     """
     Converts a time string (hh:mm:ss, mm:ss, or ss) to total seconds (float).
     Example: "1:23" → 83 seconds, "2:30:45" → 9045 seconds.
     """
-    parts = list(map(float, time_str.split(':')))
-    if len(parts) == 1:
-        return parts[0]
-    elif len(parts) == 2:
-        return parts[0] * 60 + parts[1]
-    elif len(parts) == 3:
-        return parts[0] * 3600 + parts[1] * 60 + parts[2]
-    else:
+    parts = time_str.split(':')
+    try:
+        coefficients = TIME_COEFFICIENTS[len(parts) - 1]
+    except IndexError:
         raise ValueError(f"Invalid time format: {time_str}. Use hh:mm:ss, mm:ss, or ss.")
+    return sum(float(part) * coefficient for part, coefficient in zip(parts, coefficients))
+
+@functools.lru_cache(maxsize=1)
+def get_ffmpeg_path():
+    """
+    Locates a working ffmpeg binary. The result is cached so the check only
+    runs once per process instead of on every request.
+    """
+    ffmpeg_path = shutil.which('ffmpeg') or '/usr/bin/ffmpeg'
+    try:
+        subprocess.run([ffmpeg_path, '-version'], capture_output=True, check=True)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        raise Exception("FFmpeg is not available. Please check system dependencies.")
+    return ffmpeg_path
+
+def probe_encoder(ffmpeg_path, profile):
+    """
+    Encodes a single blank frame to check that a hardware encoder actually works.
+    Distribution builds list h264_nvenc/h264_vaapi even on hosts without the hardware.
+    """
+    cmd = [
+        ffmpeg_path, '-hide_banner', '-loglevel', 'error',
+        *profile['probe'],
+        '-f', 'lavfi', '-i', 'nullsrc=s=1080x1920',
+        '-frames:v', '1',
+        '-vf', 'null' + profile['filter'],
+        *profile['encoder'],
+        *profile['quality']['balanced'],
+        '-f', 'null', '-'
+    ]
+    try:
+        subprocess.run(cmd, capture_output=True, check=True, timeout=30)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+        return False
+    return True
+
+@functools.lru_cache(maxsize=None)
+def detect_hwaccel(ffmpeg_path):
+    """
+    Returns the preferred hardware encoding profile that ffmpeg lists and that
+    passes a test encode, or None. The result is cached so the checks only run
+    once per ffmpeg binary.
+    """
+    try:
+        result = subprocess.run([ffmpeg_path, '-hide_banner', '-encoders'], capture_output=True, check=True, text=True)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+    
+    for encoder, profile in HWACCEL_PROFILES.items():
+        if encoder in result.stdout and probe_encoder(ffmpeg_path, profile):
+            return profile
+    return None
+
+def run_ffmpeg(cmd, duration, progress_bar=None):
+    """
+    Runs an ffmpeg command that writes -progress output to stdout and updates the
+    progress bar from it while the command runs.
+    Raises subprocess.CalledProcessError (with stderr) if ffmpeg fails.
+    """
+    # stderr goes to a file rather than a pipe, so ffmpeg can never block on it
+    # while we are waiting for progress lines
+    with tempfile.TemporaryFile(mode='w+') as stderr_file:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file, text=True)
+        try:
+            for line in process.stdout:
+                key, _, value = line.strip().partition('=')
+                if not progress_bar:
+                    continue
+                if key == 'out_time_ms' and value.isdigit():
+                    # Despite its name, out_time_ms is in microseconds
+                    progress_bar.progress(min(1.0, int(value) / (duration * 1e6)))
+                elif key == 'progress' and value == 'end':
+                    progress_bar.progress(1.0)
+            process.wait()
+        except BaseException:
+            # e.g. a Streamlit rerun interrupting the script; don't leave ffmpeg running
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            process.stdout.close()
+        
+        stderr_file.seek(0)
+        stderr = stderr_file.read()
+    
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr)
+    return subprocess.CompletedProcess(cmd, process.returncode, stderr=stderr)
+
+def get_direct_streams(ydl, info):
+    """
+    Returns a list of (media_url, input_args) so ffmpeg can read the selected
+    formats (e.g. separate video and audio) straight from their HTTP URLs, or None
+    if any of them is an HLS/DASH manifest. ffmpeg then only requests the byte
+    ranges it needs.
+    
+    The headers and cookies end up on ffmpeg's command line, where other local
+    users can read them (ps, /proc/<pid>/cmdline), so this must not be used when
+    the user supplied their own cookies.
+    """
+    streams = []
+    for media_format in info.get('requested_formats') or [info]:
+        media_url = media_format.get('url')
+        if not media_url or media_format.get('protocol') not in ('http', 'https'):
+            return None
+        
+        input_args = []
+        headers = ''.join(f"{key}: {value}\r\n" for key, value in media_format.get('http_headers', {}).items())
+        if headers:
+            input_args += ['-headers', headers]
+        cookies = ydl.cookiejar.get_cookies_for_url(media_url)
+        if cookies:
+            input_args += ['-cookies', ''.join(f"{c.name}={c.value}; path={c.path}; domain={c.domain};\r\n" for c in cookies)]
+        streams.append((media_url, input_args))
+    return streams
+
+def render_credits(credits_text):
+    """
+    Renders the credits text onto a transparent PNG, reusing it while it is
+    cached, so ffmpeg only blits an image instead of rasterising text on every frame.
+    Returns the path to the PNG.
+    """
+    os.makedirs(CLIP_CACHE_DIR, exist_ok=True)
+    credits_file = os.path.join(CLIP_CACHE_DIR, f"credits_{hashlib.sha256(credits_text.encode()).hexdigest()}.png")
+    if os.path.exists(credits_file):
+        os.utime(credits_file)  # Keep it from being pruned while in use
+        return credits_file
+    
+    font = ImageFont.truetype(str(CREDITS_FONT), 36)
+    left, top, right, bottom = font.getbbox(credits_text)
+    image = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+    ImageDraw.Draw(image).text((-left, -top), credits_text, font=font, fill='white')
+    # Write under a unique name first so a concurrent ffmpeg never reads a partial PNG
+    partial_file = f"{credits_file}.{uuid.uuid4().hex}.part.png"
+    image.save(partial_file)
+    os.replace(partial_file, credits_file)
+    return credits_file
+
+def acquire_temp_dir(parent=None):
+    """
+    Returns an empty temporary directory under parent, reusing a pooled one if available.
+    """
+    parent = parent or tempfile.gettempdir()
+    pool = TEMP_DIR_POOLS.setdefault(parent, queue.Queue())
+    while True:
+        try:
+            temp_dir = pool.get_nowait()
+        except queue.Empty:
+            return tempfile.mkdtemp(dir=parent)
+        # Skip directories a tmp cleaner removed while they sat in the pool
+        if os.path.isdir(temp_dir):
+            return temp_dir
+
+def release_temp_dir(temp_dir):
+    """
+    Empties a temporary directory and returns it to its pool.
+    """
+    for entry in os.scandir(temp_dir):
+        if entry.is_dir():
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+    TEMP_DIR_POOLS.setdefault(os.path.dirname(temp_dir), queue.Queue()).put(temp_dir)
+
+def cleanup_temp_dirs(temp_dirs):
+    """
+    Releases temporary directories back to their pool, ignoring errors.
+    """
+    for temp_dir in temp_dirs:
+        try:
+            print(f"Cleaning up temporary files in {temp_dir}...")
+            release_temp_dir(temp_dir)
+        except OSError:
+            pass
+
+def estimate_download_size(info):
+    """
+    Returns the approximate size in bytes of the selected formats, or 0 if unknown.
+    """
+    total = 0
+    for media_format in info.get('requested_formats') or [info]:
+        size = media_format.get('filesize') or media_format.get('filesize_approx')
+        if not size:
+            return 0
+        total += size
+    return total
+
+def make_download_dir(estimated_size):
+    """
+    Creates a temporary directory for the source download, on tmpfs if it has
+    SHM_HEADROOM_FACTOR times the estimated size free, so the merge peak can't
+    exhaust RAM. Falls back to the default temp directory.
+    """
+    if estimated_size and os.path.isdir(SHM_DIR):
+        if estimated_size * SHM_HEADROOM_FACTOR < shutil.disk_usage(SHM_DIR).free:
+            return acquire_temp_dir(SHM_DIR)
+    return acquire_temp_dir()
 
-def download_and_resize_clip(url, start_time_str, end_time_str, cookies_content=None, progress_bar=None, status_text=None):
+def hash_cookies(cookies_content):
+    """
+    Returns a short, stable key for the cookies content (or None without cookies).
+    """
+    if not cookies_content:
+        return None
+    return hashlib.sha256(cookies_content.encode()).hexdigest()
+
+@st.cache_data(max_entries=32, ttl=3600, show_spinner=False)
+def extract_video_info(url, cookies_hash, _ydl_opts):
+    """
+    Extracts (and caches) video metadata without downloading the video.
+    Keyed on the URL and cookies hash; the yt-dlp options are not hashed.
+    """
+    with yt_dlp.YoutubeDL(_ydl_opts) as ydl:
+        return ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+def download_and_resize_clip(url, start_time_str, end_time_str, cookies_content=None, progress_bar=None, status_text=None, quality='balanced', output_file=None, cookies_hash=None):
     """
     Downloads a YouTube clip and resizes it to 9:16 aspect ratio.
     
@@ -31,6 +341,9 @@ def download_and_resize_clip(url, start_time_str, end_time_str, cookies_content=
         cookies_content (str, optional): Content of cookies.txt file.
         progress_bar (streamlit.delta_generator.DeltaGenerator, optional): Streamlit progress bar element.
         status_text (streamlit.delta_generator.DeltaGenerator, optional): Streamlit text element for status.
+        quality (str, optional): One of "fast", "balanced" or "best"; selects the encoder's speed/quality settings.
+        output_file (str, optional): Where to write the processed video. Defaults to a temporary file.
+        cookies_hash (str, optional): Precomputed hash_cookies(cookies_content).
     
     Returns:
         str: Path to the processed video file.
@@ -44,157 +357,278 @@ def download_and_resize_clip(url, start_time_str, end_time_str, cookies_content=
         raise ValueError("End time must be after start time")
     
     # Create temporary directory for processing
-    temp_dir = tempfile.mkdtemp()
+    temp_dir = acquire_temp_dir()
+    download_dir = None
+    keep_temp_dir = False
     
-    # Download the video and extract channel name
-    temp_download = os.path.join(temp_dir, 'temp_download.%(ext)s')
-    
-    def my_hook(d):
-        if progress_bar and status_text:
-            if d['status'] == 'downloading':
-                percent_str = d.get('_percent_str', '0.0%')
-                speed_str = d.get('_speed_str', 'N/A')
-                eta_str = d.get('_eta_str', 'N/A')
+    try:
+        last_ui_update = 0.0
+        
+        def my_hook(d):
+            nonlocal last_ui_update
+            if progress_bar and status_text:
+                if d['status'] == 'downloading':
+                    # Progress ticks can fire dozens of times per second; limit UI updates to 10 Hz
+                    now = time.monotonic()
+                    if now - last_ui_update < 0.1:
+                        return
+                    last_ui_update = now
+                    
+                    percent_str = d.get('_percent_str', '0.0%')
+                    speed_str = d.get('_speed_str', 'N/A')
+                    eta_str = d.get('_eta_str', 'N/A')
+                    try:
+                        cleaned_percent_str = percent_str.strip('%')
+                        p = float(cleaned_percent_str) / 100.0
+                        progress_bar.progress(p)
+                    except ValueError:
+                        progress_bar.progress(0)
+                    
+                    status_text.text(f"Downloading: {percent_str} at {speed_str} (ETA: {eta_str})")
+                elif d['status'] == 'finished':
+                    progress_bar.progress(1.0)
+                    status_text.text("Download complete. Initializing processing...")
+                elif d['status'] == 'error':
+                    status_text.text("Error during download.")
+
+        ydl_opts = {
+            # The output is at most 1920px tall, so larger sources would only be thrown away
+            'format': 'bestvideo[height<=1920][ext=mp4]+bestaudio[ext=m4a]/bestvideo[height<=1920]+bestaudio/best[height<=1920][ext=mp4]/best',
+            'format_sort': ['res:1920', 'ext:mp4:m4a'],
+            'writeinfojson': False,
+            'writesubtitles': False,    
+            'writeautomaticsub': False,
+            'progress_hooks': [my_hook],
+        }
+        
+        # Add cookies if provided
+        cookies_hash = cookies_hash or hash_cookies(cookies_content)
+        if cookies_content:
+            # Written per request into the private temp dir, which is emptied when
+            # released: yt-dlp saves its cookie jar back to this file on exit, and
+            # the user's login cookies shouldn't outlive the request
+            cookies_file = os.path.join(temp_dir, 'cookies.txt')
+            with open(cookies_file, 'w') as f:
+                f.write(cookies_content)
+            ydl_opts['cookiefile'] = cookies_file
+        
+        # Extract video info to get channel name, then stream the source directly
+        # when possible instead of downloading the whole video first
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            try:
+                if status_text: status_text.text("Extracting video information...")
+                info = extract_video_info(url, cookies_hash, ydl_opts)
+                channel_name = info.get('uploader', 'Unknown Channel')
+                # User-supplied login cookies would be exposed on ffmpeg's command
+                # line, so those requests always take the download path
+                direct_streams = None if cookies_content else get_direct_streams(ydl, info)
+                if not direct_streams:
+                    if status_text: status_text.text("Starting download...")
+                    download_dir = make_download_dir(estimate_download_size(info))
+                    download_opts = {**ydl_opts, 'outtmpl': os.path.join(download_dir, 'temp_download.%(ext)s')}
+                    with yt_dlp.YoutubeDL(download_opts) as downloader:
+                        # Reuse the extracted info rather than letting ydl.download() fetch it again
+                        info = downloader.process_ie_result(info, download=True)
+            except Exception as e:
+                raise Exception(f"Failed to download video: {str(e)}")
+        
+        if direct_streams:
+            sources = direct_streams
+        else:
+            # yt-dlp records the final (possibly merged) file path, whatever its extension
+            requested_downloads = info.get('requested_downloads') or [{}]
+            downloaded_file = requested_downloads[0].get('filepath')
+            if not downloaded_file or not os.path.exists(downloaded_file):
+                raise Exception("No video file was downloaded")
+            
+            sources = [(downloaded_file, [])]
+        
+        ffmpeg_path = get_ffmpeg_path()
+        
+        # Trim, resize to 9:16 and add the credits overlay in a single ffmpeg pass.
+        # Seeking before -i jumps straight to the nearest keyframe instead of
+        # decoding from the start of the source. Because the video is re-encoded,
+        # ffmpeg then decodes and drops the frames between that keyframe and the
+        # start time (-accurate_seek, on by default), so the cut is frame-exact
+        # without probing for keyframes first. See https://trac.ffmpeg.org/wiki/Seeking
+        if status_text: status_text.text("Processing video...")
+        final_file = output_file or os.path.join(temp_dir, 'temp_final.mp4')
+        
+        credits_start = max(0, duration - 5)  # Show credits in the last 5 seconds
+        
+        resize_filter = "scale=1080:1920:force_original_aspect_ratio=increase,crop=1080:1920"
+        try:
+            credits_png = render_credits(f"credits: {channel_name} on Youtube")
+        except OSError:
+            credits_png = None
+        credits_filter = f"movie='{credits_png}'[credits];[in]{resize_filter}[resized];[resized][credits]overlay=x=(W-w)/2:y=H*0.75:enable='between(t,{credits_start},{duration})'"
+        
+        # A hardware encoder can still fail on a particular source, or transiently
+        # (e.g. a dropped stream or no free NVENC session), so libx264 is always
+        # kept as the last resort. A failure only affects this request.
+        hwaccel_profile = detect_hwaccel(ffmpeg_path)
+        hwaccel_failed = False
+        
+        def build_cmd(profile, video_filter):
+            # Each input (video, and audio when it is a separate stream) is seeked
+            # on its own; the hardware decode options only apply to the first one.
+            input_cmd = []
+            for index, (source, source_args) in enumerate(sources):
+                if index == 0:
+                    input_cmd += profile['input']
+                input_cmd += [*source_args, '-ss', str(start_time), '-i', source]
+            return [
+                ffmpeg_path,
+                '-progress', 'pipe:1',
+                '-nostats',
+                '-loglevel', 'error',
+                *input_cmd,
+                '-t', str(duration),
+                '-vf', video_filter + profile['filter'],
+                '-c:a', 'copy',
+                *profile['encoder'],
+                *profile['quality'][quality],
+                '-movflags', '+faststart',
+                '-y',
+                final_file
+            ]
+        
+        def encode(video_filter):
+            nonlocal hwaccel_failed
+            if hwaccel_profile and not hwaccel_failed:
                 try:
-                    cleaned_percent_str = percent_str.strip('%')
-                    p = float(cleaned_percent_str) / 100.0
-                    progress_bar.progress(p)
-                except ValueError:
-                    progress_bar.progress(0)
-                
-                status_text.text(f"Downloading: {percent_str} at {speed_str} (ETA: {eta_str})")
-            elif d['status'] == 'finished':
-                progress_bar.progress(1.0)
-                status_text.text("Download complete. Initializing processing...")
-            elif d['status'] == 'error':
-                status_text.text("Error during download.")
-
-    ydl_opts = {
-        'format': 'bestvideo[ext=mp4]/bestvideo/best[ext=mp4]/best',
-        'outtmpl': temp_download,
-        'writeinfojson': False,
-        'writesubtitles': False,    
-        'writeautomaticsub': False,
-        'progress_hooks': [my_hook],
-    }
-    
-    # Add cookies if provided
-    if cookies_content:
-        cookies_file = os.path.join(temp_dir, 'cookies.txt')
-        with open(cookies_file, 'w') as f:
-            f.write(cookies_content)
-        ydl_opts['cookiefile'] = cookies_file
-    
-    # Extract video info to get channel name
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                    return run_ffmpeg(build_cmd(hwaccel_profile, video_filter), duration, progress_bar)
+                except subprocess.CalledProcessError:
+                    # Don't retry the hardware encoder for the no-credits pass either
+                    hwaccel_failed = True
+            return run_ffmpeg(build_cmd(SOFTWARE_PROFILE, video_filter), duration, progress_bar)
+        
+        result = None
+        if credits_png:
+            try:
+                result = encode(credits_filter)
+            except subprocess.CalledProcessError:
+                pass
+        
+        if result is None:
+            # Process without the overlay so a credits failure doesn't lose the clip
+            if status_text: status_text.text("Credits overlay failed, processing without credits...")
+            st.warning("Credits overlay failed, proceeding without credits")
+            try:
+                result = encode(resize_filter)
+            except subprocess.CalledProcessError as e:
+                if status_text: status_text.text(f"Error processing video: {e.stderr if e.stderr else str(e)}")
+                raise Exception(f"Failed to process video: {e.stderr if e.stderr else str(e)}")
+            
+        # Without an output_file the result lives in temp_dir, so it can't be reused yet
+        keep_temp_dir = not output_file
+        if status_text: status_text.text("Processing complete!")
+        return final_file
+    finally:
+        # Clean up in the background so the clip is returned as soon as it's ready,
+        # and so failed requests don't leak their (possibly partial) downloads
+        temp_dirs = [d for d in (download_dir, None if keep_temp_dir else temp_dir) if d]
+        CLEANUP_EXECUTOR.submit(cleanup_temp_dirs, temp_dirs)
+
+def prune_clip_cache():
+    """
+    Deletes cached clips older than CLIP_CACHE_TTL and all but the newest
+    CLIP_CACHE_SIZE, along with unused credits images and partial files left
+    behind by failed runs.
+    """
+    now = time.time()
+    clips = []
+    for entry in os.scandir(CLIP_CACHE_DIR):
+        if not entry.is_file() or not entry.name.endswith(('.mp4', '.png')):
+            continue
         try:
-            if status_text: status_text.text("Extracting video information...")
-            info = ydl.extract_info(url, download=False)
-            channel_name = info.get('uploader', 'Unknown Channel')
-            if status_text: status_text.text("Starting download...")
-            ydl.download([url])
-        except Exception as e:
-            raise Exception(f"Failed to download video: {str(e)}")
+            age = now - entry.stat().st_mtime
+            if age > CLIP_CACHE_TTL:
+                os.remove(entry.path)
+            elif entry.name.endswith('.mp4') and not entry.name.endswith('.part.mp4'):
+                clips.append((age, entry.path))
+        except OSError:
+            pass
     
-    # Find the downloaded file (it might have different extensions)
-    downloaded_files = [f for f in os.listdir(temp_dir) if f.startswith('temp_download')]
-    if not downloaded_files:
-        raise Exception("No video file was downloaded")
-    
-    downloaded_file = os.path.join(temp_dir, downloaded_files[0])
-    
-    if status_text: status_text.text("Checking FFmpeg...")
-    # Check if ffmpeg is available and find its path
-    ffmpeg_path = 'ffmpeg'
-    try:
-        subprocess.run([ffmpeg_path, '-version'], capture_output=True, check=True)
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    for age, path in sorted(clips)[CLIP_CACHE_SIZE:]:
         try:
-            ffmpeg_path = '/usr/bin/ffmpeg'
-            subprocess.run([ffmpeg_path, '-version'], capture_output=True, check=True)
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            raise Exception("FFmpeg is not available. Please check system dependencies.")
-    
-    # Trim the video first
-    if status_text: status_text.text("Trimming video...")
-    trimmed_file = os.path.join(temp_dir, 'trimmed.mp4')
-    trim_cmd = [
-        ffmpeg_path,
-        '-ss', str(start_time),
-        '-i', downloaded_file,
-        '-t', str(duration),
-        '-c:v', 'copy',
-        '-an',
-        '-avoid_negative_ts', 'make_zero',
-        '-y',
-        trimmed_file
-    ]
-    
+            os.remove(path)
+        except OSError:
+            pass
+
+def process_clip(url, start_time_str, end_time_str, cookies_content=None, quality='balanced', progress_bar=None, status_text=None):
+    """
+    Returns the path of the processed clip, reusing a previous result from
+    CLIP_CACHE_DIR while it is younger than CLIP_CACHE_TTL.
+    """
+    cookies_hash = hash_cookies(cookies_content)
+    cache_key = hashlib.sha256(repr((url, start_time_str, end_time_str, cookies_hash, quality)).encode()).hexdigest()
+    os.makedirs(CLIP_CACHE_DIR, exist_ok=True)
+    clip_file = os.path.join(CLIP_CACHE_DIR, f"{cache_key}.mp4")
     try:
-        result = subprocess.run(trim_cmd, check=True, capture_output=True, text=True)
-    except subprocess.CalledProcessError as e:
-        if status_text: status_text.text(f"Error trimming video: {e.stderr if e.stderr else str(e)}")
-        raise Exception(f"Failed to trim video: {e.stderr if e.stderr else str(e)}")
-    
-    # Resize to 9:16 aspect ratio
-    if status_text: status_text.text("Resizing video...")
-    resized_file = os.path.join(temp_dir, 'temp_resized.mp4')
-    resize_cmd = [
-        ffmpeg_path,
-        "-i", trimmed_file,
-        "-vf", "scale=1080:1920:force_original_aspect_ratio=increase,crop=1080:1920",
-        "-an",
-        "-preset", "fast",
-        "-y",
-        resized_file
-    ]
+        if time.time() - os.path.getmtime(clip_file) < CLIP_CACHE_TTL:
+            return clip_file
+    except OSError:
+        pass
     
+    # Encode under a unique name and move it into place, so concurrent requests
+    # for the same clip never write to or serve a half-written file
+    partial_file = os.path.join(CLIP_CACHE_DIR, f"{cache_key}.{uuid.uuid4().hex}.part.mp4")
     try:
-        result = subprocess.run(resize_cmd, check=True, capture_output=True, text=True)
-    except subprocess.CalledProcessError as e:
-        if status_text: status_text.text(f"Error resizing video: {e.stderr if e.stderr else str(e)}")
-        raise Exception(f"Failed to resize video: {e.stderr if e.stderr else str(e)}")
-    
-    # Add credits overlay in the last 5 seconds
-    if status_text: status_text.text("Adding credits...")
-    final_file = os.path.join(temp_dir, 'temp_final.mp4')
-    
-    credits_text = f"credits: {channel_name} on Youtube"
-    credits_text_escaped = credits_text.replace("'", r"\'").replace(":", r"\:")
-    credits_start = max(0, duration - 5)  # Show credits in the last 5 seconds
+        download_and_resize_clip(
+            url, start_time_str, end_time_str, cookies_content,
+            progress_bar, status_text,
+            quality=quality,
+            output_file=partial_file,
+            cookies_hash=cookies_hash
+        )
+        os.replace(partial_file, clip_file)
+    finally:
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
     
-    credits_cmd = [
-        ffmpeg_path,
-        "-i", resized_file,
-        "-vf", f"drawtext=text='{credits_text_escaped}':fontsize=36:fontcolor=white:x=(w-text_w)/2:y=h*0.75:enable='between(t,{credits_start},{duration})'",
-        "-an",
-        "-preset", "fast",
-        "-y",
-        final_file
-    ]
+    prune_clip_cache()
+    return clip_file
+
+def run_clip_task(url, start_time_str, end_time_str, cookies_content=None, quality='balanced', status_text=None):
+    """
+    Queues the clip on a Celery worker and polls until it finishes. If the same
+    clip is already running for this session (e.g. after a rerun), that task is
+    resumed instead of queuing a new one. Tasks that don't finish within
+    CELERY_TASK_TIMEOUT seconds are revoked.
     
-    try:
-        result = subprocess.run(credits_cmd, check=True, capture_output=True, text=True)
-    except subprocess.CalledProcessError as e:
-        if status_text: status_text.text("Credits overlay failed, using resized video.")
-        st.warning("Credits overlay failed, proceeding without credits")
-        final_file = resized_file
+    Returns:
+        str: Path to the processed video file.
+    """
+    from tasks import process_clip_task, select_queue
     
-    if status_text: status_text.text("Cleaning up temporary files...")
+    task_key = (url, start_time_str, end_time_str, hash_cookies(cookies_content), quality)
+    running = st.session_state.get('clip_task')
+    if running and running['key'] == task_key:
+        task = process_clip_task.AsyncResult(running['id'])
+    else:
+        task = process_clip_task.apply_async(
+            (url, start_time_str, end_time_str, cookies_content, quality),
+            queue=select_queue()
+        )
+        running = {'id': task.id, 'key': task_key, 'deadline': time.time() + CELERY_TASK_TIMEOUT}
+        st.session_state['clip_task'] = running
     
-    try:
-        print("Cleaning up temporary files...")
-        if os.path.exists(downloaded_file):
-            os.remove(downloaded_file)
-        if os.path.exists(trimmed_file) and trimmed_file != final_file:
-            os.remove(trimmed_file)
-        if os.path.exists(resized_file) and resized_file != final_file:
-            os.remove(resized_file)
-    except Exception:
-        pass
+    while not task.ready():
+        if time.time() > running['deadline']:
+            task.revoke(terminate=True)
+            del st.session_state['clip_task']
+            raise Exception("Timed out waiting for a worker to process the clip")
+        if status_text:
+            if task.state == 'PENDING':
+                status_text.text("Waiting for a free worker...")
+            else:
+                status_text.text("Downloading and processing on worker...")
+        time.sleep(1)
     
-    if status_text: status_text.text("Processing complete!")
-    return final_file
+    del st.session_state['clip_task']
+    # Re-raises the worker's exception if the task failed
+    return task.get()
 
 def main():
     st.set_page_config(
@@ -230,6 +664,14 @@ def main():
                 help="Format: ss, mm:ss, or hh:mm:ss"
             )
         
+        quality = st.selectbox(
+            "Quality",
+            options=list(QUALITY_OPTIONS),
+            index=1,
+            format_func=str.capitalize,
+            help="Fast encodes quickest with a larger file, Best gives the highest quality but takes longest"
+        )
+        
         st.subheader("Optional: Browser Cookies")
         cookies_content = st.text_area(
             "Paste cookies.txt content",
@@ -267,11 +709,16 @@ def main():
         
         try:
             with st.spinner("Downloading and processing video... Please wait."):
-                processed_video_path = download_and_resize_clip(
-                    url, start_time, end_time, 
-                    cookies_content.strip() if cookies_content else None,
-                    progress_bar, status_text
-                )
+                cookies_content = cookies_content.strip() if cookies_content else None
+                if CELERY_BROKER_URL:
+                    processed_video_path = run_clip_task(
+                        url, start_time, end_time, cookies_content, quality, status_text
+                    )
+                else:
+                    processed_video_path = process_clip(
+                        url, start_time, end_time, cookies_content, quality,
+                        progress_bar, status_text
+                    )
                 
                 status_text.success("✅ Video processed successfully!")
                 progress_bar.progress(1.0)
@@ -282,17 +729,16 @@ def main():
                 
                 col1, col2, col3 = st.columns([2, 1, 2])
                 with col2:
-                    with open(processed_video_path, 'rb') as video_file:
-                        video_bytes = video_file.read()
-                        st.video(video_bytes)
+                    st.video(processed_video_path)
                 
                 filename = f"clip_{start_time.replace(':', '-')}_to_{end_time.replace(':', '-')}.mp4"
-                st.download_button(
-                    label="📥 Download Processed Video",
-                    data=video_bytes,
-                    file_name=filename,
-                    mime="video/mp4"
-                )
+                with open(processed_video_path, 'rb') as video_file:
+                    st.download_button(
+                        label="📥 Download Processed Video",
+                        data=video_file,
+                        file_name=filename,
+                        mime="video/mp4"
+                    )
                 
                 col1, col2, col3 = st.columns(3)
                 with col1:
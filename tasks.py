@@ -0,0 +1,51 @@
+import os
+import time
+from celery import Celery
+
+from streamlit_app import process_clip, CELERY_TASK_TIMEOUT
+
+# Broker and result backend are shared by the Streamlit app and the workers.
+# Workers must also share CLIPPER_CACHE_DIR with the app so the returned path can be served.
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')
+CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND', CELERY_BROKER_URL)
+
+# GPU and CPU workers consume separate queues:
+#   celery -A tasks worker -Q gpu_transcode   (hosts with a hardware encoder)
+#   celery -A tasks worker -Q cpu_transcode   (everything else)
+# Each task goes to the GPU queue while a worker is consuming it, otherwise to the CPU queue.
+GPU_QUEUE = 'gpu_transcode'
+CPU_QUEUE = 'cpu_transcode'
+
+# How long the set of consumed queues is reused before workers are asked again
+QUEUE_CHECK_INTERVAL = 60
+
+celery_app = Celery('clipper', broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND)
+celery_app.conf.update(
+    task_track_started=True,
+    task_default_queue=CPU_QUEUE,
+)
+
+_consumed_queues = {'names': set(), 'checked_at': 0.0}
+
+def select_queue():
+    """
+    Returns the queue for a new task: GPU_QUEUE if any worker currently consumes it,
+    otherwise CPU_QUEUE. Worker queues are looked up at most every QUEUE_CHECK_INTERVAL seconds.
+    """
+    if time.monotonic() - _consumed_queues['checked_at'] > QUEUE_CHECK_INTERVAL:
+        active_queues = celery_app.control.inspect(timeout=1).active_queues() or {}
+        _consumed_queues['names'] = {queue['name'] for queues in active_queues.values() for queue in queues}
+        _consumed_queues['checked_at'] = time.monotonic()
+    return GPU_QUEUE if GPU_QUEUE in _consumed_queues['names'] else CPU_QUEUE
+
+# The soft limit raises inside the task, so run_ffmpeg() kills ffmpeg and the
+# partial output is removed; the hard limit is a backstop if that hangs.
+@celery_app.task(soft_time_limit=CELERY_TASK_TIMEOUT, time_limit=CELERY_TASK_TIMEOUT + 60)
+def process_clip_task(url, start_time_str, end_time_str, cookies_content=None, quality='balanced'):
+    """
+    Downloads and processes a clip on a worker.
+    
+    Returns:
+        str: Path to the processed video file.
+    """
+    return process_clip(url, start_time_str, end_time_str, cookies_content, quality)